@@ -25,19 +25,50 @@ import argparse
 import sys
 import gettext
 import re
-from datetime import datetime
+import time
 import threading
-import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs
 import socket
+import subprocess
+import queue
+import struct
+import hashlib
+import functools
+import gc
+from collections import OrderedDict
+
+# Keep the --compile kernel cache next to the app instead of /tmp, so it survives reboots
+os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'inductor'))
+
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
+# Optional in-process encoder, ffmpeg is run as a subprocess without it
+try:
+    import av
+except ImportError:
+    av = None
 
 import torch
+
+# Let the CUDA allocator grow and shrink segments instead of fragmenting; set the variable to override
+# Not on ROCm builds, where the option is not supported; the allocator reads the variable on first use
+if torch.version.hip is None:
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512')
+
 import gradio as gr
-import numpy
-from pydub import AudioSegment
 from rich_argparse import RichHelpFormatter
 from whisperspeech.pipeline import Pipeline
+from whisperspeech.modules import EmbeddingProjector
+
+# Allow TF32 matmuls for the remaining float32 layers
+torch.set_float32_matmul_precision('high')
+
+# Checked once, the device does not change while the app runs
+cuda_available = torch.cuda.is_available()
 
 # Version
 version = '2.2.1'
@@ -60,6 +91,15 @@ MODELS = {
     'base': 'collabora/whisperspeech:s2a-q4-base-en+pl.model'
 }
 
+# Define available compute types (activation type, int8 weights)
+COMPUTE_TYPES = {
+    'fp32': (torch.float32, False),
+    'fp16': (torch.float16, False),
+    'bf16': (torch.bfloat16, False),
+    'int8_fp16': (torch.float16, True),
+    'int8_bf16': (torch.bfloat16, True)
+}
+
 # Text
 info = '%s<br><br>%s<br><a %s</a><br><a %s</a>' % (
     _('This is a simple web UI for the %s project.') % '<b>WhisperSpeech</b>',
@@ -95,87 +135,548 @@ parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, he
 parser.add_argument('-i', '--api', action='store_true', help=_('Enable API mode.'))
 parser.add_argument('-o', '--api-port', metavar=(_('<port>')), type=int, default=5050, help=_('Specify the server port for the API.'))
 parser.add_argument('-m', '--model', choices=MODELS.keys(), default="tiny", help=_('Select the default model tiny/small/base.'))
+parser.add_argument('-t', '--compute-type', choices=['auto', *COMPUTE_TYPES.keys()], default='fp16', help=_('Select the precision of the T2S and S2A models auto/fp32/fp16/bf16/int8_fp16/int8_bf16 (auto uses bf16 where the GPU supports it, int8_* stores the weights in int8 and computes in fp16/bf16).'))
+parser.add_argument('-c', '--compile', action='store_true', help=_('Compile the models with torch.compile (slower startup, faster generation).'))
+parser.add_argument('-n', '--max-cached-models', metavar=(_('<count>')), type=int, default=1, help=_('Specify how many models are kept loaded at the same time.'))
+parser.add_argument('-e', '--idle-timeout', metavar=(_('<seconds>')), type=int, default=0, help=_('Unload models that have not been used for the given number of seconds (0 keeps them loaded).'))
+parser.add_argument('-d', '--verbose', action='store_true', help=_('Print the parameters of every generation request.'))
+parser.add_argument('-r', '--no-persist', action='store_true', help=_('Send the audio generated through the API without saving it to a file.'))
 parser.add_argument('-v', '--api-voice', metavar=(_('<path>')), help=_('Specify the path to an mp3, wav, or ogg file for voice cloning when using the API.'))
 args = parser.parse_args()
 
 # Set the default model
 default_model = MODELS[args.model]
 
-def split_text(text):
-    sentences_with_tags = re.findall(r'(<en>|<pl>)?\s*([^<]*)', text)
-    sentences = [(tag.strip('<>') if tag else 'en', sentence.strip()) for tag, sentence in sentences_with_tags if sentence.strip()]
+# Set the compute type
+if args.compute_type == 'auto':
+    args.compute_type = 'bf16' if cuda_available and torch.cuda.is_bf16_supported() else 'fp16'
+compute_dtype, compute_int8 = COMPUTE_TYPES[args.compute_type]
 
-    return ['  ' + element[1] + '  '  for element in sentences],[element[0] for element in sentences]
+# Compiled decoding relies on CUDA graphs
+if args.compile and not cuda_available:
+    print(_('Compilation requires a ROCm/CUDA device. Running without it.'))
+    args.compile = False
 
-# Model, text, slider value, voice, audio format
-def update(m,t,s,v,af):
-    if not torch.cuda.is_available():
-        cuda_device = _('No ROCm/CUDA device available.')
-        gr.Error(cuda_device)
-        print(cuda_device)
-    else:
-        print(_('ROCm/CUDA device available.'))
-
-    print('\n',m,'\n',t,'\n',s,'\n',v,'\n',af)
-    pipe = Pipeline(s2a_ref=m)
+# Compiled vocoder inputs are padded to a few fixed lengths (see decode_audio), so tuning the convolutions pays off
+torch.backends.cudnn.benchmark = args.compile
 
-    speaker = pipe.default_speaker
+# Generated audio files
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'outputs')
+os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    if v != None:
-        speaker = pipe.extract_spk_emb(v)
+# Seconds an API request waits for its audio
+api_timeout = 600
 
-    split = split_text(t)
-    print(split[0])
-    print(split[1])
-    tensor = pipe.vocoder.decode(pipe.s2a.generate(pipe.t2s.generate(split[0], cps=s, lang=split[1])[0], speaker.unsqueeze(0)))
+# Language tags
+TAG_RE = re.compile(r'<(en|pl)>')
 
-    np = (tensor.cpu().numpy() * 32767).astype(numpy.int16)
-
-    if len(np.shape) == 1:
-        np = np.expand_dims(np, axis=0)
+# Text between two tags is spoken in the language of the first one, English before any tag
+def split_text(text):
+    # Untagged text is a single English segment, no scan needed
+    if '<' not in text:
+        text = text.strip()
+        return ([text], ['en']) if text else ([], [])
+
+    sentences = []
+    langs = []
+    lang = 'en'
+    start = 0
+    for match in TAG_RE.finditer(text):
+        sentence = text[start:match.start()].strip()
+        if sentence:
+            sentences.append(sentence)
+            langs.append(lang)
+        lang = match.group(1)
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        sentences.append(sentence)
+        langs.append(lang)
+
+    return sentences, langs
+
+# Int8 weight-only linear layer (based on gpt-fast)
+class WeightOnlyInt8Linear(torch.nn.Module):
+    def __init__(self, linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-5) / 127
+        self.register_buffer('weight', torch.round(weight / scales.unsqueeze(1)).to(torch.int8))
+        self.register_buffer('scales', scales.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def forward(self, x):
+        out = torch.nn.functional.linear(x, self.weight.to(x.dtype)) * self.scales
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+# Replace the linear layers of a model, keeping the output projections in their original precision
+def quantize_int8(model):
+    skip = set(model.head.modules()) if hasattr(model, 'head') else set()
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Linear) and not isinstance(child, EmbeddingProjector) and child not in skip:
+                if child.weight.is_cuda:
+                    setattr(module, name, WeightOnlyInt8Linear(child))
+                elif type(child) is torch.nn.Linear:
+                    # Dynamic quantization has real int8 kernels on the CPU
+                    child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+                    setattr(module, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+
+# Loaded pipelines, shared by the GUI and the API, least recently used first
+pipelines = OrderedDict()
+last_used = {}
+pipeline_lock = threading.Lock()
+generation_lock = threading.Lock()
+
+def unload_pipeline(m):
+    # The previous job's vocoder and copy may still be reading the weights on the copy stream
+    if copy_stream is not None:
+        copy_stream.synchronize()
+    del pipelines[m], last_used[m]
+    if args.compile:
+        # The compiled code is cached per code object with guards on the old modules, and the CUDA graph
+        # pools are kept by the graph trees; without a reset every reload recompiles next to the stale entries
+        from torch._inductor.cudagraph_trees import reset_cudagraph_trees
+        torch._dynamo.reset()
+        reset_cudagraph_trees()
+    gc.collect()
+    if cuda_available:
+        torch.cuda.empty_cache()
+
+# Called with generation_lock held, so no evicted pipeline is still generating
+def get_pipeline(m):
+    with pipeline_lock:
+        if m not in pipelines:
+            # Free the memory of the evicted models before loading the new one
+            while pipelines and len(pipelines) >= max(args.max_cached_models, 1):
+                unload_pipeline(next(iter(pipelines)))
+            pipe = Pipeline(s2a_ref=m, torch_compile=args.compile)
+            if compute_int8 and not cuda_available:
+                # The dynamic int8 kernels take float32 activations
+                pipe.t2s.switch_dtypes(torch.float32)
+                pipe.s2a.switch_dtypes(torch.float32)
+            elif compute_dtype != torch.float16:
+                pipe.t2s.switch_dtypes(compute_dtype)
+                pipe.s2a.switch_dtypes(compute_dtype)
+            if compute_int8:
+                quantize_int8(pipe.t2s)
+                quantize_int8(pipe.s2a)
+            if args.compile:
+                # The T2S/S2A decoding steps are compiled with CUDA graphs by the pipeline itself,
+                # the vocoder gets one CUDA graph per padded length (see decode_audio)
+                pipe.vocoder.vocos.decode = torch.compile(pipe.vocoder.vocos.decode, mode='reduce-overhead')
+            pipelines[m] = pipe
+        pipelines.move_to_end(m)
+        last_used[m] = time.monotonic()
+        return pipelines[m]
+
+# Unload models that have been idle for longer than --idle-timeout
+def evict_idle():
+    while True:
+        time.sleep(min(args.idle_timeout, 60))
+        with generation_lock, pipeline_lock:
+            for m in [m for m in pipelines if time.monotonic() - last_used[m] > args.idle_timeout]:
+                unload_pipeline(m)
+                print(_('Unloaded idle model %s.') % m)
+
+# Speaker embeddings of recently used voice files, keyed by content hash
+speaker_cache = OrderedDict()
+SPEAKER_CACHE_SIZE = 64
+
+# The hash is remembered per path, modification time and size, so unchanged files are not read again
+@functools.lru_cache(maxsize=SPEAKER_CACHE_SIZE)
+def hash_file(path, mtime, size):
+    with open(path, 'rb') as file:
+        return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+def get_speaker(pipe, path):
+    stat = os.stat(path)
+    key = hash_file(path, stat.st_mtime_ns, stat.st_size)
+    if key in speaker_cache:
+        speaker_cache.move_to_end(key)
     else:
-        np = np.T
+        # Stored with the batch dimension S2A expects
+        speaker_cache[key] = pipe.extract_spk_emb(path).unsqueeze(0)
+        if len(speaker_cache) > SPEAKER_CACHE_SIZE:
+            speaker_cache.popitem(last=False)
+    return speaker_cache[key]
+
+# Reusable pinned host buffers for the device to host copy, keyed by size
+pinned_buffers = {}
+pinned_lock = threading.Lock()
+# Page-locked memory is scarce, extra buffers of a size are freed instead of kept
+PINNED_BUFFERS_PER_SIZE = 2
+
+def take_pinned_buffer(n):
+    # Round up to a power of two so similar lengths share buffers
+    size = 1 << max(n - 1, 0).bit_length()
+    with pinned_lock:
+        if pinned_buffers.get(size):
+            return pinned_buffers[size].pop()
+    return torch.empty(size, dtype=torch.int16, pin_memory=True)
+
+def release_pinned_buffer(buffer):
+    with pinned_lock:
+        free = pinned_buffers.setdefault(buffer.numel(), [])
+        if len(free) < PINNED_BUFFERS_PER_SIZE:
+            free.append(buffer)
+
+# Audio codecs for the output formats
+CODECS = {
+    'mp3': 'libmp3lame',
+    'ogg': 'libvorbis'
+}
 
+# RIFF header of a 24 kHz mono int16 WAV file
+def wav_header(size):
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + size, b'WAVE', b'fmt ', 16, 1, 1, 24000, 48000, 2, 16, b'data', size)
+
+# Writes the same bytes to several file objects
+class Tee:
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def write(self, data):
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+# Encode with the libav libraries linked by PyAV, without spawning ffmpeg
+def encode_with_av(pcm, outputs, fmt):
+    with av.open(Tee(outputs), 'w', format=fmt) as container:
+        stream = container.add_stream(CODECS[fmt], rate=24000)
+        stream.layout = 'mono'
+        frame = av.AudioFrame.from_ndarray(pcm.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = 24000
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        # Flush the encoder
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+def feed(stream, data):
+    # ffmpeg closes its input early when it fails or is killed
     try:
-        audio_segment = AudioSegment(
-            np.tobytes(),
-            frame_rate=24000,
-            sample_width=2,
-            channels=1
-        )
-        filename = '%s/outputs/audio_%s.%s' % (os.path.dirname(os.path.realpath(__file__)), datetime.now().strftime('%Y-%m-%d_%H:%M:%S'), af)
-        audio_segment.export(filename, format=af)
+        with stream:
+            stream.write(data)
+    except BrokenPipeError:
+        pass
+
+# Encode 24 kHz mono int16 PCM into each of the outputs as the bytes are produced
+def write_audio(pcm, outputs, fmt):
+    data = memoryview(pcm).cast('B')
+
+    # WAV is only a header in front of the samples
+    if fmt == 'wav':
+        header = wav_header(len(data))
+        for output in outputs:
+            output.write(header)
+            output.write(data)
+        return
+
+    # Not every PyAV build ships every encoder
+    if av is not None and CODECS[fmt] in av.codecs_available:
+        encode_with_av(pcm, outputs, fmt)
+        return
+
+    process = subprocess.Popen(
+        ['ffmpeg', '-loglevel', 'error', '-f', 's16le', '-ar', '24000', '-ac', '1', '-i', 'pipe:0', '-codec:a', CODECS[fmt], '-f', fmt, 'pipe:1'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    # Feed ffmpeg from another thread so its output can be passed on while it encodes
+    feeder = threading.Thread(target=feed, args=(process.stdin, data))
+    feeder.start()
+    try:
+        for chunk in iter(lambda: process.stdout.read(65536), b''):
+            for output in outputs:
+                output.write(chunk)
+    except BaseException:
+        # Nobody reads the output any more, stop ffmpeg so the feeder is not blocked forever
+        process.kill()
+        raise
+    finally:
+        feeder.join()
+        error = process.stderr.read()
+        process.stdout.close()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(error.decode(errors='replace').strip())
+
+# Write the audio to a file and, if given, a sink that receives the same bytes; without a path only the sink gets them
+def encode_audio(pcm, path, fmt, sink=None):
+    # Checked before the file is opened, so no empty file is left behind
+    if fmt != 'wav' and fmt not in CODECS:
+        raise ValueError(_('Unsupported audio format: %s') % fmt)
+    if path is None:
+        write_audio(pcm, [sink], fmt)
+        return
+    with open(path, 'wb') as file:
+        write_audio(pcm, [file] if sink is None else [file, sink], fmt)
+
+# Scale a waveform to int16 PCM in place, rounding to the nearest value instead of truncating
+# The output is mono, so the flat buffer is already in PCM order
+def to_int16(tensor):
+    return tensor.float().mul_(32767).round_().clamp_(-32768, 32767).to(torch.int16).reshape(-1)
+
+# Compiled vocoder inputs are padded to a multiple of this many frames, so a CUDA graph
+# is captured once per bucket instead of once per length
+VOCODER_BUCKET = 128
+# Audio samples per vocoder frame
+SAMPLES_PER_FRAME = 320
+
+def decode_audio(pipe, atoks):
+    if not args.compile:
+        return pipe.vocoder.decode(atoks)
+    frames = atoks.shape[-1]
+    # Repeat the last frame instead of padding with token 0, the vocoder looks at the frames on both sides
+    padding = atoks[..., -1:].expand(*atoks.shape[:-1], -frames % VOCODER_BUCKET)
+    padded = torch.cat([atoks, padding], dim=-1)
+    # The graph output lives in the CUDA graph memory pool, so take a copy before the next replay reuses it
+    return pipe.vocoder.decode(padded)[..., :frames * SAMPLES_PER_FRAME].clone()
+
+# Side stream for the vocoder and the device to host copy, so the next request can start on the default stream
+copy_stream = torch.cuda.Stream() if cuda_available else None
+
+# Model, text, slider value, voice
+def generate_audio(m,t,s,v):
+    if args.verbose:
+        print('\n',m,'\n',t,'\n',s,'\n',v)
+    # Only one generation runs on the device at a time, encoding happens outside the lock
+    with generation_lock:
+        pipe = get_pipeline(m)
+
+        # No autograd bookkeeping; autocast in the type of the T2S/S2A weights so they are not re-cast
+        with torch.inference_mode(), torch.autocast('cuda', dtype=compute_dtype, enabled=cuda_available and compute_dtype != torch.float32):
+            speaker = pipe.default_speaker.unsqueeze(0) if v is None else get_speaker(pipe, v)
+
+            sentences, langs = split_text(t)
+            if args.verbose:
+                print(sentences)
+                print(langs)
+            # All sentences go through T2S as one sequence with per-character language ids,
+            # the spaces around each sentence keep the segments apart
+            stoks = pipe.t2s.generate([f'  {sentence}  ' for sentence in sentences], cps=s, lang=langs)[0]
+            # Drop the end-of-text padding so S2A only decodes the actual speech
+            stoks = stoks[stoks != pipe.t2s.stoks_codes - 1]
+            atoks = pipe.s2a.generate(stoks, speaker)
+
+            if copy_stream is None:
+                tensor = decode_audio(pipe, atoks)
+                return to_int16(tensor).numpy(), None, None
+
+            # The compiled vocoder stays on the default stream, so the next job's graph replays are ordered after it
+            if args.compile:
+                tensor = decode_audio(pipe, atoks)
+
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                if not args.compile:
+                    tensor = decode_audio(pipe, atoks)
+
+                # Convert to int16 on the device so only 2 bytes per sample are copied
+                audio = to_int16(tensor)
+
+                buffer = take_pinned_buffer(audio.numel())
+                buffer[:audio.numel()].copy_(audio, non_blocking=True)
+                copied = copy_stream.record_event()
+            atoks.record_stream(copy_stream)
+            tensor.record_stream(copy_stream)
+
+    return buffer[:audio.numel()].numpy(), buffer, copied
+
+# PCM, pinned buffer, copy event, audio format, optional sink for the encoded bytes
+# Returns the output file, or None if the audio only went to the sink; raises if encoding failed
+def save_audio(pcm,buffer,copied,af,sink=None):
+    try:
+        if copied is not None:
+            copied.synchronize()
+        # API audio that is not persisted only goes to the response
+        if sink is not None and args.no_persist:
+            encode_audio(pcm, None, af, sink)
+            return None
+        filename = os.path.join(OUTPUT_DIR, 'audio_%x.%s' % (time.time_ns(), af))
+        encode_audio(pcm, filename, af, sink)
         print(_('Audio file generated: %s') % filename)
         return filename
     except Exception as e:
-        file_error = str(_('Error:'), f'{e}')
-        gr.Error(file_error)
+        file_error = _('Error:') + f' {e}'
         print(file_error)
+        # Shown in the GUI, the API answers with an error status
+        raise gr.Error(file_error) from e
+    finally:
+        if buffer is not None:
+            release_pinned_buffer(buffer)
+
+# Drop generated audio nobody waits for
+def discard_audio(pcm,buffer,copied):
+    if copied is not None:
+        # The copy may still be writing into the buffer
+        copied.synchronize()
+    if buffer is not None:
+        release_pinned_buffer(buffer)
+
+# Generation job
+class Job:
+    def __init__(self, args, sink=None):
+        self.args = args
+        self.sink = sink
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Set when nobody waits for the audio any more, the worker and the encoder then skip the job
+        self.cancelled = False
+
+    def finish(self):
+        self.done.set()
+        # Tell the API handler that no more audio is coming
+        if self.sink is not None:
+            self.sink.close()
+
+# Jobs from the GUI and the API, generated one at a time by a single worker that owns the device
+jobs = queue.Queue()
+# Generated audio waiting to be encoded, so the worker can start on the next job
+# Bounded, so a slow encoder holds the worker back instead of piling up pinned buffers
+encode_jobs = queue.Queue(maxsize=4)
+
+def worker():
+    while True:
+        job = jobs.get()
+        if job.cancelled:
+            job.finish()
+            continue
+        m, t, s, v, af = job.args
+        try:
+            encode_jobs.put((job, generate_audio(m, t, s, v), af))
+        except Exception as e:
+            job.error = e
+            job.finish()
+
+def encoder():
+    while True:
+        job, audio, af = encode_jobs.get()
+        try:
+            if job.cancelled:
+                discard_audio(*audio)
+                continue
+            job.result = save_audio(*audio, af, job.sink)
+        except Exception as e:
+            job.error = e
+        finally:
+            job.finish()
+
+def submit(job_args, sink=None):
+    job = Job(job_args, sink)
+    jobs.put(job)
+    return job
+
+def enqueue_and_wait(job_args, timeout=None):
+    job = submit(job_args)
+    if not job.done.wait(timeout):
+        job.cancelled = True
+        return None
+    if job.error is not None:
+        raise job.error
+    return job.result
+
+# GUI callback, Gradio names the API endpoint after it (/update)
+def update(m,t,s,v,af):
+    return enqueue_and_wait((m, t, s, v, af))
+
+# Response body sent with chunked transfer encoding as the audio is encoded
+# The encoder only queues the chunks, the handler thread sends them, so a slow client cannot stall other jobs
+class ChunkedResponse:
+    def __init__(self, handler, content_type):
+        self.handler = handler
+        self.content_type = content_type
+        self.chunks = queue.Queue()
+        self.started = False
+
+    # Called by the encoder
+    def write(self, data):
+        if len(data) > 0:
+            self.chunks.put(bytes(data))
+        return len(data)
+
+    # Called by the encoder once the job is finished
+    def close(self):
+        self.chunks.put(None)
+
+    # Send the chunks until the job is finished, returns False if it took longer than the timeout
+    def send(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                chunk = self.chunks.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return False
+            if chunk is None:
+                return True
+            self.send_headers()
+            self.handler.wfile.write(b'%x\r\n' % len(chunk))
+            self.handler.wfile.write(chunk)
+            self.handler.wfile.write(b'\r\n')
+
+    def send_headers(self):
+        if not self.started:
+            self.handler.send_response(200)
+            self.handler.send_header('Content-type', self.content_type)
+            self.handler.send_header('Transfer-Encoding', 'chunked')
+            self.handler.send_header('Access-Control-Allow-Origin', '*')  # Allow CORS
+            self.handler.end_headers()
+            self.started = True
+
+    def end(self):
+        self.send_headers()
+        self.handler.wfile.write(b'0\r\n\r\n')
 
 # API functionality
 class WhisperSpeechHandler(BaseHTTPRequestHandler):
+    # Needed for chunked responses
+    protocol_version = 'HTTP/1.1'
+    # Drop clients that stop reading
+    timeout = api_timeout
+
     def do_POST(self):
         if self.path == '/generate':
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = orjson.loads(post_data)
 
             text = data.get('text', '')
             speed = data.get('speed', 13.5)
             audio_format = data.get('format', 'wav')
+            if audio_format != 'wav' and audio_format not in CODECS:
+                self.send_error(400, _('Unsupported audio format: %s') % audio_format)
+                return
 
             # Use the API voice if specified
             voice = args.api_voice if args.api_voice else None
 
-            output_file = update(default_model, text, speed, voice, audio_format)
-
-            if output_file:
-                self.send_response(200)
-                self.send_header('Content-type', f'audio/{audio_format}')
-                self.send_header('Access-Control-Allow-Origin', '*')  # Allow CORS
-                self.end_headers()
-                with open(output_file, 'rb') as file:
-                    self.wfile.write(file.read())
+            # The audio is streamed to the client while it is written to the output file
+            response = ChunkedResponse(self, f'audio/{audio_format}')
+            job = submit((default_model, text, speed, voice, audio_format), sink=response)
+
+            try:
+                finished = response.send(api_timeout)
+            except OSError:
+                # The client disconnected
+                job.cancelled = True
+                self.close_connection = True
+                return
+
+            if not finished:
+                job.cancelled = True
+
+            if finished and job.error is None:
+                response.end()
+            elif response.started:
+                # Failed halfway through the body
+                self.close_connection = True
             else:
                 self.send_error(500, _('Error generating audio.'))
         else:
@@ -186,11 +687,15 @@ class WhisperSpeechHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-def run_api(host, port):
+def run_api(host, port, ready=None):
     server_address = (host, port)
-    httpd = HTTPServer(server_address, WhisperSpeechHandler)
+    httpd = ThreadingHTTPServer(server_address, WhisperSpeechHandler)
+    # Hold the port but only start answering once the default model is loaded
+    if ready is not None:
+        ready.join()
     print(_('API running on http://%s:%s') % (host,port))
 
     httpd.serve_forever()
@@ -253,29 +758,63 @@ with gr.Blocks(
 
 def is_port_available(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # Ignore sockets left in TIME_WAIT; on Windows the option would let the bind take a port in use
+        if os.name != 'nt':
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             s.bind(('', port))
             return True
         except OSError:
             return False
 
-def find_available_port(start_port):
-    port = start_port
-    while not is_port_available(port):
-        port += 1
-    return port
+# Use the requested port if it is free, otherwise let the OS pick one
+def find_available_port(port):
+    if is_port_available(port):
+        return port
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
 
 def check_extension(filename):
     allowed_extensions = ('.mp3', '.ogg', '.wav')
     return filename.lower().endswith(allowed_extensions)
 
+# Load the default model and run one generation, so the first request does not pay
+# for loading, CUDA initialization and compilation
+# It goes through the worker, because CUDA graphs are recorded per thread
+def warmup():
+    try:
+        warmup_file = enqueue_and_wait((default_model, 'Warmup.', 13.5, None, 'wav'))
+        if warmup_file:
+            os.remove(warmup_file)
+    except Exception as e:
+        print(_('Warmup failed: %s') % e)
+
+    if cuda_available:
+        print(_('Peak VRAM usage: %.0f MiB') % (torch.cuda.max_memory_allocated() / 2**20))
+
 # Main execution
 if __name__ == '__main__':
     print(_('Version:') + ' ' + version)
+    if cuda_available:
+        print(_('ROCm/CUDA device available.'))
+    else:
+        print(_('No ROCm/CUDA device available.'))
     host = '127.0.0.1'
     if args.listen or args.share:
         host = '0.0.0.0'
 
+    # Warm up the default model in the background
+    warmup_thread = threading.Thread(target=warmup, daemon=True)
+    warmup_thread.start()
+
+    # Start the generation worker and the encoder
+    threading.Thread(target=worker, daemon=True).start()
+    threading.Thread(target=encoder, daemon=True).start()
+
+    if args.idle_timeout > 0:
+        threading.Thread(target=evict_idle, daemon=True).start()
+
     # Find an available port starting from the specified port
     port = find_available_port(args.port)
     if port != args.port:
@@ -299,12 +838,12 @@ if __name__ == '__main__':
             print(_('API port %s is busy. Using port %s instead.') % (args.api_port,api_port))
 
         if api_port == port:
-            print(_('API port %s is the same as the GUI port. Using port %s instead.') % (api_port,api_port + 1))
-            api_port = find_available_port(api_port + 1)
+            api_port, busy_port = find_available_port(api_port + 1), api_port
+            print(_('API port %s is the same as the GUI port. Using port %s instead.') % (busy_port,api_port))
 
         print("\n")
 
-        api_thread = threading.Thread(target=run_api, args=(api_host, api_port))
+        api_thread = threading.Thread(target=run_api, args=(api_host, api_port, warmup_thread))
         api_thread.start()
 
     # Launch Gradio UI